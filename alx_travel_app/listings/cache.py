@@ -0,0 +1,13 @@
+"""
+Cache keys and lifetimes for the listings app.
+"""
+
+# payment_status responses: short-lived while Chapa may still move the
+# payment, long-lived once it is completed or failed
+PAYMENT_STATUS_PENDING_TIMEOUT = 30
+PAYMENT_STATUS_FINAL_TIMEOUT = 3600
+
+
+def payment_status_key(payment_id):
+    """Return the cache key for a payment_status response."""
+    return f"pay:{payment_id}"
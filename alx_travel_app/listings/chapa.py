@@ -0,0 +1,32 @@
+"""
+Shared HTTP client for the Chapa payment API.
+Keeps TCP/TLS connections to api.chapa.co alive across requests.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+# Built once at import; attached to the session so call sites pass no headers
+CHAPA_HEADERS = {
+    "Authorization": f"Bearer {settings.CHAPA_SECRET_KEY}",
+    "Content-Type": "application/json",
+}
+
+INITIALIZE_URL = f"{settings.CHAPA_BASE_URL}/transaction/initialize"
+VERIFY_URL = f"{settings.CHAPA_BASE_URL}/transaction/verify/"
+
+# (connect, read) timeouts. Initialization runs on the request thread, so a
+# stalled Chapa must not pin a web worker; verification runs in Celery.
+INITIALIZE_TIMEOUT = (3.05, 10)
+VERIFY_TIMEOUT = (3.05, 30)
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+session.headers.update(CHAPA_HEADERS)
@@ -32,6 +32,7 @@ class Booking(models.Model):
         ('confirmed', 'Confirmed'),
         ('cancelled', 'Cancelled')
     ], default='pending')
+    payment_attempts = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
@@ -42,7 +43,7 @@ class Payment(models.Model):
     """Model for tracking payment transactions"""
     payment_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='payments')
-    transaction_id = models.CharField(max_length=255, blank=True, null=True)
+    transaction_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='ETB')
     payment_status = models.CharField(max_length=20, choices=[
@@ -51,10 +52,16 @@ class Payment(models.Model):
         ('failed', 'Failed')
     ], default='pending')
     payment_method = models.CharField(max_length=50, blank=True, null=True)
-    chapa_reference = models.CharField(max_length=255, blank=True, null=True)
+    chapa_reference = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     checkout_url = models.URLField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    verified_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['booking', 'payment_status']),
+        ]
     
     def __str__(self):
         return f"Payment {self.payment_id} - {self.payment_status}"
\ No newline at end of file
@@ -3,15 +3,34 @@ Celery tasks for the listings app.
 """
 
 from celery import shared_task
-from django.core.mail import send_mail
+from django.core.mail import get_connection, send_mail
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils import timezone
+from functools import lru_cache
 import logging
+import requests
+
+from . import chapa
+from .cache import payment_status_key
+from .models import Booking, Payment
 
 logger = logging.getLogger(__name__)
 
+# Chapa transaction statuses after which the payment can no longer succeed
+CHAPA_FAILED_STATUSES = ('failed', 'cancelled')
+
+
+@lru_cache(maxsize=None)
+def _email_template(name):
+    """Load and parse an email template once per worker process."""
+    return get_template(name)
+
 
 @shared_task
-def send_booking_confirmation_email(booking_id, user_email, listing_name, check_in_date, check_out_date):
+def send_booking_confirmation_email(booking_id, user_email, listing_name, check_in_date, check_out_date, guests=1):
     """
     Send a booking confirmation email to the user.
     
@@ -21,6 +40,7 @@ def send_booking_confirmation_email(booking_id, user_email, listing_name, check_
         listing_name: The name of the listing/property
         check_in_date: Check-in date
         check_out_date: Check-out date
+        guests: Number of guests
     
     Returns:
         str: Success or failure message
@@ -28,38 +48,209 @@ def send_booking_confirmation_email(booking_id, user_email, listing_name, check_
     try:
         subject = f'Booking Confirmation - {listing_name}'
         
-        message = f"""
-        Dear Customer,
-        
-        Thank you for your booking!
+        context = {
+            'booking_id': booking_id,
+            'listing_name': listing_name,
+            'check_in_date': check_in_date,
+            'check_out_date': check_out_date,
+            'guests': guests,
+        }
+        message = _email_template('emails/booking_confirmation.txt').render(context)
+        html_message = _email_template('emails/booking_confirmation.html').render(context)
         
-        Booking Details:
-        ----------------
-        Booking ID: {booking_id}
-        Property: {listing_name}
-        Check-in Date: {check_in_date}
-        Check-out Date: {check_out_date}
+        # Send the email
+        send_mail(
+            subject=subject,
+            message=message,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            recipient_list=[user_email],
+            html_message=html_message,
+            fail_silently=False,
+        )
         
-        Your booking has been confirmed. We look forward to hosting you!
+        logger.info(f"Booking confirmation email sent successfully for booking {booking_id}")
+        return f"Email sent successfully to {user_email}"
         
-        If you have any questions, please don't hesitate to contact us.
+    except Exception as e:
+        logger.error(f"Failed to send booking confirmation email for booking {booking_id}: {str(e)}")
+        raise
+
+
+@shared_task
+def send_bulk_booking_emails(booking_ids):
+    """
+    Send booking confirmation emails for several bookings in one task.
+    
+    All emails go out over a single mail backend connection. A failure for
+    one booking is logged and does not stop the rest.
+    
+    Args:
+        booking_ids: Primary keys of the bookings to confirm
+    
+    Returns:
+        str: Summary of the emails sent
+    """
+    bookings = Booking.objects.filter(pk__in=booking_ids).select_related('user', 'listing')
+    sent = 0
+    
+    with get_connection() as connection:
+        for booking in bookings:
+            context = {
+                'booking_id': booking.id,
+                'listing_name': booking.listing.title,
+                'check_in_date': str(booking.check_in),
+                'check_out_date': str(booking.check_out),
+                'guests': booking.guests,
+            }
+            try:
+                send_mail(
+                    subject=f'Booking Confirmation - {booking.listing.title}',
+                    message=_email_template('emails/booking_confirmation.txt').render(context),
+                    from_email=settings.DEFAULT_FROM_EMAIL,
+                    recipient_list=[booking.user.email],
+                    html_message=_email_template('emails/booking_confirmation.html').render(context),
+                    fail_silently=False,
+                    connection=connection,
+                )
+                sent += 1
+            except Exception as e:
+                logger.error(f"Failed to send booking confirmation email for booking {booking.id}: {str(e)}")
+    
+    logger.info(f"Sent {sent} of {len(booking_ids)} bulk booking confirmation emails")
+    return f"Sent {sent} of {len(booking_ids)} emails"
+
+
+@shared_task
+def send_payment_confirmation_email(user_email, booking_id, amount, check_in, check_out, listing_name):
+    """
+    Send a payment confirmation email to the user.
+    
+    Args:
+        user_email: The email address of the user
+        booking_id: The ID of the booking
+        amount: The amount paid
+        check_in: Check-in date
+        check_out: Check-out date
+        listing_name: The name of the listing/property
+    
+    Returns:
+        str: Success or failure message
+    """
+    try:
+        subject = f'Payment Received - {listing_name}'
         
-        Best regards,
-        ALX Travel App Team
-        """
+        context = {
+            'booking_id': booking_id,
+            'listing_name': listing_name,
+            'amount': amount,
+            'check_in': check_in,
+            'check_out': check_out,
+        }
+        message = _email_template('emails/payment_confirmation.txt').render(context)
+        html_message = _email_template('emails/payment_confirmation.html').render(context)
         
-        # Send the email
         send_mail(
             subject=subject,
             message=message,
             from_email=settings.DEFAULT_FROM_EMAIL,
             recipient_list=[user_email],
+            html_message=html_message,
             fail_silently=False,
         )
         
-        logger.info(f"Booking confirmation email sent successfully for booking {booking_id}")
+        logger.info(f"Payment confirmation email sent successfully for booking {booking_id}")
         return f"Email sent successfully to {user_email}"
         
     except Exception as e:
-        logger.error(f"Failed to send booking confirmation email for booking {booking_id}: {str(e)}")
-        raise
\ No newline at end of file
+        logger.error(f"Failed to send payment confirmation email for booking {booking_id}: {str(e)}")
+        raise
+
+
+@shared_task(autoretry_for=(requests.RequestException,), retry_backoff=True, max_retries=3)
+def verify_payment_task(tx_ref):
+    """
+    Verify a transaction with Chapa and confirm the related booking.
+    
+    Safe to run more than once for the same tx_ref: the pending payment
+    row is locked for the update, so only one run confirms the booking and
+    queues the confirmation email. The payment is only marked failed on a
+    terminal Chapa status; anything else leaves it pending for a later run.
+    
+    Args:
+        tx_ref: The transaction reference sent to Chapa
+    
+    Returns:
+        str: The resulting payment status
+    """
+    response = chapa.session.get(
+        f"{chapa.VERIFY_URL}{tx_ref}",
+        timeout=chapa.VERIFY_TIMEOUT
+    )
+    response_data = response.json()
+
+    if response.status_code != 200 or response_data.get('status') != 'success':
+        logger.error(f"Chapa verification failed for {tx_ref}: {response_data}")
+        return 'verification_failed'
+
+    payment_info = response_data['data']
+
+    with transaction.atomic():
+        # Lock the pending payment; a concurrent run for the same tx_ref skips
+        # the locked row and returns at once instead of processing it twice
+        payment = (
+            Payment.objects.select_for_update(skip_locked=True, of=('self',))
+            .select_related('booking__user', 'booking__listing')
+            .only(
+                'id', 'payment_id', 'amount', 'payment_status',
+                'booking__id', 'booking__booking_id', 'booking__check_in', 'booking__check_out',
+                'booking__status', 'booking__user__email', 'booking__listing__title',
+            )
+            .filter(transaction_id=tx_ref, payment_status='pending')
+            .first()
+        )
+
+        if not payment:
+            logger.info(f"Payment for tx_ref {tx_ref} already processed")
+            return 'already_processed'
+
+        # robust=True: a cache outage must not stop the hooks queued after this one
+        transaction.on_commit(
+            lambda: cache.delete(payment_status_key(payment.payment_id)), robust=True
+        )
+
+        if payment_info['status'] in CHAPA_FAILED_STATUSES:
+            payment.payment_status = 'failed'
+            payment.save(update_fields=['payment_status', 'updated_at'])
+            return 'failed'
+
+        if payment_info['status'] != 'success':
+            # Not settled yet (e.g. an early frontend poll); a later verify
+            # can still complete the payment
+            logger.info(f"Payment for tx_ref {tx_ref} still {payment_info['status']} at Chapa")
+            return 'pending'
+
+        payment.payment_status = 'completed'
+        payment.payment_method = payment_info.get('payment_method', '')
+        payment.chapa_reference = payment_info.get('reference')
+        payment.verified_at = timezone.now()
+        payment.save(update_fields=[
+            'payment_status', 'payment_method', 'chapa_reference', 'verified_at', 'updated_at'
+        ])
+
+        # Update booking
+        booking = payment.booking
+        booking.status = 'confirmed'
+        booking.save(update_fields=['status'])
+
+        # Email only once both rows are committed
+        transaction.on_commit(lambda: send_payment_confirmation_email.delay(
+            user_email=booking.user.email,
+            booking_id=str(booking.booking_id),
+            amount=str(payment.amount),
+            check_in=str(booking.check_in),
+            check_out=str(booking.check_out),
+            listing_name=booking.listing.title
+        ), robust=True)
+
+    logger.info(f"Payment confirmed and email queued for booking {booking.booking_id}")
+    return 'completed'
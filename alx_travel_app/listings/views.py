@@ -3,25 +3,57 @@ Views for the listings app.
 Handles booking creation, Chapa payment integration, and confirmation workflows.
 """
 
-import uuid
+import re
+import hashlib
 import logging
 import requests
+from functools import lru_cache
 
-from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
+from django.utils.http import quote_etag
 
 from rest_framework import viewsets, status
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
+from alx_travel_app.celery import app as celery_app
+
+from . import chapa
+from .cache import PAYMENT_STATUS_FINAL_TIMEOUT, PAYMENT_STATUS_PENDING_TIMEOUT, payment_status_key
 from .models import Booking, Payment, Listing
 from .serializers import BookingSerializer
-from .tasks import send_booking_confirmation_email, send_payment_confirmation_email
+from .tasks import send_booking_confirmation_email, send_bulk_booking_emails, verify_payment_task
 
 logger = logging.getLogger(__name__)
 
+# Format of the tx_ref values generated by initiate_payment: tx-<booking_id>-<attempt>,
+# or tx-<uuid4> for payments initiated before attempts were numbered
+_TX_REF_RE = re.compile(
+    r'tx-[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}(-[1-9][0-9]*)?'
+)
+
+# Maximum number of bookings accepted by one bulk create request
+BULK_BOOKING_LIMIT = 500
+
+# Static part of the Chapa initialize payload, merged into each request's payload
+_CHAPA_BASE_PAYLOAD = {
+    "currency": "ETB",
+    "customization": {
+        "title": "Travel Booking Payment",
+    },
+}
+
+
+@lru_cache(maxsize=32)
+def _chapa_redirect_urls(scheme, host):
+    """Return the (callback_url, return_url) pair sent to Chapa for a host."""
+    base_url = f"{scheme}://{host}"
+    return f"{base_url}/api/payments/verify/", f"{base_url}/bookings/"
+
 
 # =============================================================================
 # Booking ViewSet - Clean, DRY, and Scalable
@@ -39,38 +71,104 @@ class BookingViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Return only the current user's bookings."""
-        return Booking.objects.filter(user=self.request.user).select_related('listing', 'user')
+        queryset = Booking.objects.filter(user=self.request.user)
+        if self.action == 'initiate_payment':
+            # Payment initiation reads only these booking columns (the payer is
+            # request.user), and its completed-payment check is answered by an
+            # annotation in the same query
+            return queryset.only('id', 'booking_id', 'total_price').annotate(
+                has_completed_payment=Exists(
+                    Payment.objects.filter(booking=OuterRef('pk'), payment_status='completed')
+                ),
+            )
+        return queryset.select_related('listing', 'user')
 
     def perform_create(self, serializer):
         """Create booking and queue confirmation email."""
-        booking = serializer.save(user=self.request.user, status='pending')
+        with transaction.atomic():
+            booking = serializer.save(user=self.request.user, status='pending')
+            # Publish only once the row is committed and visible to workers
+            transaction.on_commit(lambda: self.queue_confirmation_email(booking))
         logger.info(f"Booking {booking.booking_id} created by user {self.request.user.id}")
 
-        # Queue email confirmation
+    def queue_confirmation_email(self, booking):
+        """
+        Publish the confirmation email task for a booking.
+        Uses a pooled producer and publishes without retry so the request
+        never blocks on the broker.
+        """
         try:
-            send_booking_confirmation_email.delay(
-                booking_id=booking.id,
-                user_email=self.request.user.email,
-                listing_name=booking.listing.name,
-                check_in_date=str(booking.check_in),
-                check_out_date=str(booking.check_out),
-                guests=booking.guests
-            )
+            with celery_app.producer_pool.acquire(block=True) as producer:
+                send_booking_confirmation_email.apply_async(
+                    kwargs={
+                        'booking_id': booking.id,
+                        'user_email': booking.user.email,
+                        'listing_name': booking.listing.title,
+                        'check_in_date': str(booking.check_in),
+                        'check_out_date': str(booking.check_out),
+                        'guests': booking.guests,
+                    },
+                    producer=producer,
+                    retry=False,
+                )
             logger.info(f"Booking confirmation email queued for booking {booking.id}")
         except Exception as e:
             logger.error(f"Failed to queue booking email for {booking.id}: {str(e)}")
 
     def create(self, request, *args, **kwargs):
-        """Override create to return user-friendly message."""
+        """
+        Override create to return user-friendly message.
+        Returns only the booking identifiers and a Location header; pass
+        ?full=1 to include the serialized booking.
+        """
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         self.perform_create(serializer)
 
-        headers = self.get_success_headers(serializer.data)
-        return Response({
+        booking = serializer.instance
+        data = {
             'message': 'Booking created successfully. Confirmation email will be sent shortly.',
-            'booking': serializer.data
-        }, status=status.HTTP_201_CREATED, headers=headers)
+            'id': booking.pk,
+            'booking_id': str(booking.booking_id)
+        }
+        if request.query_params.get('full') == '1':
+            data['booking'] = serializer.data
+
+        return Response(data, status=status.HTTP_201_CREATED, headers={
+            'Location': f'/api/bookings/{booking.pk}/'
+        })
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_create(self, request):
+        """
+        Create several bookings in one request.
+        POST /api/bookings/bulk/
+        Accepts a non-empty list of at most BULK_BOOKING_LIMIT booking
+        payloads; all rows are inserted together and confirmation emails
+        are sent by a single task.
+        """
+        serializer = self.get_serializer(
+            data=request.data, many=True, allow_empty=False, max_length=BULK_BOOKING_LIMIT
+        )
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            bookings = Booking.objects.bulk_create(
+                [
+                    Booking(**{**attrs, 'user': request.user, 'status': 'pending'})
+                    for attrs in serializer.validated_data
+                ],
+                batch_size=BULK_BOOKING_LIMIT
+            )
+            booking_ids = [booking.id for booking in bookings]
+            # robust=True logs a broker failure instead of failing the committed request
+            transaction.on_commit(lambda: send_bulk_booking_emails.delay(booking_ids), robust=True)
+        logger.info(f"{len(bookings)} bookings created in bulk by user {request.user.id}")
+
+        return Response({
+            'message': f'{len(bookings)} bookings created successfully. Confirmation emails will be sent shortly.',
+            'booking_ids': [str(booking.booking_id) for booking in bookings]
+        }, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=['post'], url_path='initiate-payment')
     def initiate_payment(self, request, pk=None):
@@ -81,41 +179,41 @@ class BookingViewSet(viewsets.ModelViewSet):
         booking = self.get_object()
 
         # Prevent re-initiating payment if already paid
-        if booking.payments.filter(payment_status='completed').exists():
+        if booking.has_completed_payment:
             return Response({
                 'error': 'This booking already has a completed payment.'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        # Generate unique transaction reference
-        tx_ref = f"tx-{uuid.uuid4()}"
+        # Derive the transaction reference from the booking. The attempt counter
+        # is bumped under the row lock, so concurrent or retried initiations
+        # (even ones Chapa rejected) never reuse a tx_ref
+        with transaction.atomic():
+            Booking.objects.filter(pk=booking.pk).update(payment_attempts=F('payment_attempts') + 1)
+            attempt = Booking.objects.values_list('payment_attempts', flat=True).get(pk=booking.pk)
+        tx_ref = f"tx-{booking.booking_id}-{attempt}"
 
         # Prepare Chapa payload
+        callback_url, return_url = _chapa_redirect_urls(request.scheme, request.get_host())
         payment_data = {
-            "amount": str(booking.total_price),
-            "currency": "ETB",
+            **_CHAPA_BASE_PAYLOAD,
+            "amount": format(booking.total_price, 'f'),
             "email": request.user.email,
             "first_name": request.user.first_name or request.user.username,
             "last_name": request.user.last_name or "",
             "tx_ref": tx_ref,
-            "callback_url": request.build_absolute_uri('/api/payments/verify/'),
-            "return_url": request.build_absolute_uri('/bookings/'),
+            "callback_url": callback_url,
+            "return_url": return_url,
             "customization": {
-                "title": "Travel Booking Payment",
+                **_CHAPA_BASE_PAYLOAD["customization"],
                 "description": f"Payment for booking {booking.booking_id}"
             }
         }
 
-        headers = {
-            "Authorization": f"Bearer {settings.CHAPA_SECRET_KEY}",
-            "Content-Type": "application/json"
-        }
-
         try:
-            response = requests.post(
-                f"{settings.CHAPA_BASE_URL}/transaction/initialize",
+            response = chapa.session.post(
+                chapa.INITIALIZE_URL,
                 json=payment_data,
-                headers=headers,
-                timeout=30
+                timeout=chapa.INITIALIZE_TIMEOUT
             )
             response_data = response.json()
 
@@ -127,7 +225,6 @@ class BookingViewSet(viewsets.ModelViewSet):
                     amount=booking.total_price,
                     currency='ETB',
                     payment_status='pending',
-                    chapa_reference=tx_ref,
                     checkout_url=response_data['data']['checkout_url']
                 )
 
@@ -166,81 +263,34 @@ class BookingViewSet(viewsets.ModelViewSet):
 @api_view(['GET', 'POST'])
 def verify_payment(request):
     """
-    Verify payment status with Chapa.
-    Called by Chapa webhook or frontend polling.
+    Queue payment verification with Chapa.
+    Called by Chapa webhook or frontend polling. The Chapa round-trip and
+    booking confirmation run in a Celery worker; poll payment_status for
+    the outcome.
     """
     tx_ref = request.GET.get('tx_ref') or request.data.get('tx_ref')
 
     if not tx_ref:
         return Response({'error': 'tx_ref is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-    headers = {"Authorization": f"Bearer {settings.CHAPA_SECRET_KEY}"}
+    # Reject unknown references before spending a Chapa call on them
+    if not _TX_REF_RE.fullmatch(tx_ref):
+        return Response({'error': 'Invalid tx_ref'}, status=status.HTTP_400_BAD_REQUEST)
 
-    try:
-        response = requests.get(
-            f"{settings.CHAPA_BASE_URL}/transaction/verify/{tx_ref}",
-            headers=headers,
-            timeout=30
-        )
-        response_data = response.json()
+    if not Payment.objects.filter(transaction_id=tx_ref).exists():
+        return Response({'error': 'Payment record not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        if response.status_code != 200 or response_data.get('status') != 'success':
-            return Response({
-                'error': 'Payment verification failed',
-                'details': response_data
-            }, status=status.HTTP_400_BAD_REQUEST)
-
-        payment_info = response_data['data']
-        payment = Payment.objects.filter(transaction_id=tx_ref).first()
-
-        if not payment:
-            return Response({'error': 'Payment record not found'}, status=status.HTTP_404_NOT_FOUND)
-
-        if payment_info['status'] == 'success':
-            payment.payment_status = 'completed'
-            payment.payment_method = payment_info.get('payment_method', '')
-            payment.verified_at = timezone.now()
-            payment.save()
-
-            # Update booking
-            booking = payment.booking
-            booking.status = 'confirmed'
-            booking.save()
-
-            # Send confirmation email
-            try:
-                send_payment_confirmation_email.delay(
-                    user_email=booking.user.email,
-                    booking_id=str(booking.booking_id),
-                    amount=str(payment.amount),
-                    check_in=str(booking.check_in),
-                    check_out=str(booking.check_out),
-                    listing_name=booking.listing.name
-                )
-                logger.info(f"Payment confirmation email queued for booking {booking.booking_id}")
-            except Exception as e:
-                logger.error(f"Failed to queue payment email: {str(e)}")
-
-            return Response({
-                'message': 'Payment verified and confirmed',
-                'booking_id': str(booking.booking_id),
-                'payment_status': 'completed'
-            }, status=status.HTTP_200_OK)
-
-        else:
-            payment.payment_status = 'failed'
-            payment.save()
-            return Response({
-                'message': 'Payment failed',
-                'payment_status': 'failed'
-            }, status=status.HTTP_400_BAD_REQUEST)
-
-    except requests.RequestException as e:
-        logger.error(f"Chapa verification request failed: {str(e)}")
-        return Response({'error': 'Verification service unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        verify_payment_task.delay(tx_ref)
+        logger.info(f"Payment verification queued for tx_ref {tx_ref}")
     except Exception as e:
-        logger.exception(f"Unexpected error in verify_payment: {str(e)}")
-        return Response({'error': 'Internal server error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        logger.error(f"Failed to queue payment verification for {tx_ref}: {str(e)}")
+        return Response({'error': 'Verification service unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    return Response({
+        'status': 'processing',
+        'transaction_reference': tx_ref
+    }, status=status.HTTP_202_ACCEPTED)
 
 
 @api_view(['GET'])
@@ -249,26 +299,57 @@ def payment_status(request, payment_id):
     """
     Get payment status for a user.
     GET /api/payments/status/{payment_id}/
+    Responses are cached per payment until verification changes its state,
+    and carry an ETag so repeat polls can be answered with 304.
     """
     try:
-        payment = get_object_or_404(Payment, payment_id=payment_id)
+        key = payment_status_key(payment_id)
+        try:
+            entry = cache.get(key)
+        except Exception as e:
+            # The cache is an optimisation only; fall back to the database
+            logger.warning(f"payment_status cache read failed for {payment_id}: {str(e)}")
+            entry = None
+
+        if entry is None:
+            payment = get_object_or_404(
+                Payment.objects.select_related('booking'),
+                payment_id=payment_id
+            )
+            etag = hashlib.md5(
+                f"{payment.payment_status}:{payment.updated_at.isoformat()}".encode(),
+                usedforsecurity=False
+            ).hexdigest()
+            entry = {
+                'user_id': payment.booking.user_id,
+                'etag': quote_etag(etag),
+                'data': {
+                    'payment_id': str(payment.payment_id),
+                    'booking_id': str(payment.booking.booking_id),
+                    'amount': str(payment.amount),
+                    'currency': payment.currency,
+                    'status': payment.payment_status,
+                    'transaction_id': payment.transaction_id,
+                    'checkout_url': payment.checkout_url,
+                    'created_at': payment.created_at,
+                    'updated_at': payment.updated_at,
+                    'verified_at': payment.verified_at
+                },
+            }
+            timeout = (
+                PAYMENT_STATUS_PENDING_TIMEOUT if payment.payment_status == 'pending'
+                else PAYMENT_STATUS_FINAL_TIMEOUT
+            )
+            try:
+                cache.set(key, entry, timeout)
+            except Exception as e:
+                logger.warning(f"payment_status cache write failed for {payment_id}: {str(e)}")
 
-        if payment.booking.user != request.user:
+        if entry['user_id'] != request.user.id:
             return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
 
-        return Response({
-            'payment_id': str(payment.payment_id),
-            'booking_id': str(payment.booking.booking_id),
-            'amount': str(payment.amount),
-            'currency': payment.currency,
-            'status': payment.payment_status,
-            'transaction_id': payment.transaction_id,
-            'checkout_url': payment.checkout_url,
-            'created_at': payment.created_at,
-            'updated_at': payment.updated_at,
-            'verified_at': payment.verified_at
-        }, status=status.HTTP_200_OK)
+        return Response(entry['data'], status=status.HTTP_200_OK, headers={'ETag': entry['etag']})
 
     except Exception as e:
         logger.error(f"Error in payment_status: {str(e)}")
-        return Response({'error': 'Failed to retrieve payment status'}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        return Response({'error': 'Failed to retrieve payment status'}, status=status.HTTP_400_BAD_REQUEST)